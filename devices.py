@@ -11,3 +11,11 @@ devices = {
     'BG_lamp': { 'type': 'bulb', 'gwid': '087537652462ab50bb0b', 'ip': '192.168.68.66', 'key': 'qd=xJ_|[jQm(&Oh{', 'version': 3.3 },
     'big_light': { 'type': 'bulb', 'gwid': '087537652462ab50bdfd', 'ip': '192.168.68.58', 'key': 'OA*&w#(tgA3={esp', 'version': 3.3 }
 }
+
+# Zigbee hubs keyed by IP.  Devices at one of these IPs that also have a
+# 'cid' (their Zigbee node id) are addressed through the hub's session;
+# all other devices keep their own session.  Such devices may also set a
+# 'bulb_type' (tinytuya's 'A', 'B' or 'C') so that their DP layout is known
+# without polling them first.
+# e.g. '192.168.68.50': { 'gwid': '...', 'key': '...', 'version': 3.3 }
+gateways = {}
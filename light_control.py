@@ -1,20 +1,151 @@
+import os
 import sys
+import json
+import time
+import zlib
+import struct
+import binascii
 import colorsys
+import functools
+import contextlib
+import threading
+import collections
 import tinytuya
-from devices import devices
+from devices import devices, gateways
 
 # Map types to tinytuya classes
 device_class = {
     'bulb': tinytuya.BulbDevice,
-    'plug': tinytuya.OutletDevice
+    'plug': tinytuya.OutletDevice,
+    'gateway': tinytuya.Device
 }
 
 # When ``False``, :func:`load_preset` will ignore plug devices
 # (i.e. sockets) so that only bulbs are modified.
 UPDATE_PLUGS_ON_PRESET_LOAD = True
 
-# Maximum brightness level supported by bulbs
+# Maximum brightness level supported by bulbs whose range is unknown
 MAX_BRIGHTNESS = 256
+
+# Colour temperature range, in Kelvin, accepted by the ``temp`` verb
+KELVIN_MIN = 2700
+KELVIN_MAX = 6500
+
+# Reported ``dps`` snapshots are reused for ``SHADOW_MAX_AGE`` seconds before
+# the device is polled again.  Successful writes are overlaid on top of the
+# reported state until the device confirms them or ``SHADOW_TTL`` seconds
+# pass, so chained read-modify-write commands see their own writes.
+SHADOW_MAX_AGE = 2.0
+SHADOW_TTL = 10.0
+
+# Shadow fields mapped to the ``dps`` keys they may be reported under and
+# the key used when the device has not reported any of them yet.
+_SHADOW_KEYS = {
+    'on': (('switch', '1', 20), '1'),
+    'mode': (('mode', 21), '21'),
+    'colour': (('colour', 'color', 'colour_data', 'color_data', 24), '24'),
+    'bright': (('bright', 'brightness', 'value', 'bright_value',
+                'bright_value_v2', 25), '25'),
+    'temp': (('temp', 'colourtemp', 'color_temp', 'temp_value',
+              'temp_value_v2', 26), '26'),
+}
+
+_shadow = {}
+_shadow_lock = threading.Lock()
+
+# Capability profiles learned from the first report of each device, keyed
+# like the shadow state.  See :func:`device_profile`.
+_profiles = {}
+
+# Number of worker processes used by get_all_states, load_preset and
+# all_on/all_off.  ``0`` or ``1`` keeps all device I/O in this process.
+SHARD_WORKERS = 0
+
+# How the inventory is split across workers: ``'hash'`` spreads devices by
+# a hash of their IP, ``'subnet'`` keeps each /24 on a single worker.
+# Devices sharing an IP always land on the same worker.
+SHARD_BY = 'hash'
+
+# Persistent device sessions of a shard worker, keyed by device name.
+# ``None`` in the coordinating process.
+_sessions = None
+_shard_executors = []
+
+# When ``True``, devices with a ``cid`` whose IP is listed in
+# ``devices.gateways`` are treated as sub-devices of that hub: they are
+# addressed by ``cid`` through a single gateway session and preset changes
+# for them are sent as one pipelined batch.
+BATCH_GATEWAY_DEVICES = True
+
+# Open gateway sessions keyed by hub IP, and their sub-devices by name.
+_gateways = {}
+_sub_devices = {}
+_gateway_lock = threading.Lock()
+
+# Protocol 3.3 CONTROL frames are encrypted once per device and ``dps``
+# payload and reused, with only the sequence number and CRC rewritten, for
+# ``FRAME_CACHE_TTL`` seconds.  3.3 devices do not check the embedded
+# timestamp, so the TTL merely bounds how stale it gets.
+FRAME_CACHE_TTL = 3600.0
+
+# Maximum number of cached frames; the least recently used are evicted.
+FRAME_CACHE_SIZE = 256
+
+_frame_cache = collections.OrderedDict()
+_frame_lock = threading.Lock()
+
+# When set, every CLI and API invocation is appended to this file as a JSON
+# line (see ``replay.py``).
+TRACE_FILE = os.environ.get('LIGHT_CONTROL_TRACE')
+
+_trace_lock = threading.Lock()
+_trace_depth = threading.local()
+
+
+def record_invocation(verb, device=None, args=(), kwargs=None):
+    """Append an invocation of *verb* to ``TRACE_FILE`` if tracing."""
+
+    if not TRACE_FILE:
+        return
+    entry = {
+        'ts': time.time(),
+        'verb': verb,
+        'device': device,
+        'args': list(args),
+    }
+    if kwargs:
+        entry['kwargs'] = kwargs
+    line = json.dumps(entry)
+    with _trace_lock:
+        with open(TRACE_FILE, 'a') as fh:
+            fh.write(line + '\n')
+
+
+def _traced(func):
+    """Record calls to the API function *func*, ignoring nested calls."""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with _trace_scope() as outermost:
+            if outermost:
+                record_invocation(func.__name__, None, args, kwargs)
+            return func(*args, **kwargs)
+    return wrapper
+
+
+@contextlib.contextmanager
+def _trace_scope():
+    """Mark calls made inside the block as nested, so they are not traced.
+
+    Yields ``True`` if the block is the outermost traced call.
+    """
+
+    depth = getattr(_trace_depth, 'value', 0)
+    _trace_depth.value = depth + 1
+    try:
+        yield depth == 0
+    finally:
+        _trace_depth.value = depth
 
 
 def usage():
@@ -44,21 +175,411 @@ def resolve_name(raw):
 
 
 def get_device(name):
+    if _sessions is not None and name in _sessions:
+        return _sessions[name]
+
     cfg = devices[name]
     cls = device_class.get(cfg['type'])
     if not cls:
         raise ValueError(f"Unsupported device type: {cfg['type']}")
 
-    dev = cls(cfg['gwid'], cfg['ip'], cfg['key'])
-    dev.set_socketPersistent(True)
-    dev.set_version(cfg['version'])
-    try:
-        dev.status()
-    except Exception:
-        pass
+    hub_ip = _gateway_ip(name)
+    if hub_ip is not None:
+        dev = _sub_device(name, cls, hub_ip)
+    else:
+        dev = cls(cfg['gwid'], cfg['ip'], cfg['key'])
+        dev.set_socketPersistent(True)
+        dev.set_version(cfg['version'])
+        if cfg['version'] == 3.3:
+            _enable_frame_cache(dev)
+        try:
+            _record_status(dev, dev.status())
+        except Exception:
+            pass
+    if _sessions is not None:
+        _sessions[name] = dev
     return dev
 
 
+def _gateway_ip(name):
+    """Return the hub IP of *name* if it is a sub-device, else ``None``.
+
+    A device is a sub-device only if it has an explicit ``cid`` (its Zigbee
+    node id) and its IP is configured in ``devices.gateways``.
+    """
+
+    if not BATCH_GATEWAY_DEVICES:
+        return None
+    cfg = devices[name]
+    if 'cid' not in cfg or cfg.get('ip') not in gateways:
+        return None
+    return cfg['ip']
+
+
+def _sub_device(name, cls, ip):
+    """Return the session of sub-device *name* behind the hub at *ip*.
+
+    Each sub-device is created once per hub session and is not polled, so
+    that batches to many sub-devices cost a single hub round trip.  A
+    ``bulb_type`` in its configuration tells tinytuya and
+    :func:`device_profile` its DP layout up front.
+    """
+
+    hub = _gateway(ip)
+    with _gateway_lock:
+        dev = _sub_devices.get(name)
+        if dev is not None:
+            return dev
+
+        cfg = devices[name]
+        dev = cls(cfg['gwid'], cid=cfg['cid'], parent=hub)
+        # frames of sub-devices are encoded by the gateway session
+        if gateways[ip]['version'] == 3.3:
+            _enable_frame_cache(dev)
+        bulb_type = cfg.get('bulb_type')
+        if bulb_type in _BULB_TYPES:
+            if hasattr(dev, 'set_bulb_type'):
+                dev.set_bulb_type(bulb_type)
+            with _shadow_lock:
+                _profiles.setdefault(_shadow_key(dev), _learn_profile(
+                    {}, variant=_BULB_TYPES[bulb_type]))
+        _sub_devices[name] = dev
+        return dev
+
+
+def _gateway(ip):
+    """Return the shared session of the hub described by ``gateways[ip]``."""
+
+    with _gateway_lock:
+        hub = _gateways.get(ip)
+        if hub is None:
+            cfg = gateways[ip]
+            hub = device_class['gateway'](cfg['gwid'], ip, cfg['key'])
+            hub.set_socketPersistent(True)
+            hub.set_version(cfg['version'])
+            _gateways[ip] = hub
+        return hub
+
+
+def _enable_frame_cache(dev):
+    """Serve repeated CONTROL payloads of *dev* from ``_frame_cache``."""
+
+    if not hasattr(dev, '_encode_message'):
+        return
+    generate = dev.generate_payload
+
+    def generate_payload(command, data=None, *args, **kwargs):
+        if (command == tinytuya.CONTROL and isinstance(data, dict)
+                and not args and not kwargs):
+            try:
+                return _cached_frame(dev, generate, data)
+            except TypeError:
+                # unhashable dps values, build the payload as usual
+                pass
+        return generate(command, data, *args, **kwargs)
+
+    dev.generate_payload = generate_payload
+
+
+def _cached_frame(dev, generate, data):
+    """Return an encoded protocol 3.3 CONTROL frame setting *data*.
+
+    The encrypted body is built by tinytuya on first use and cached; later
+    frames only get a fresh sequence number and CRC.  Returning bytes
+    rather than a ``MessagePayload`` makes tinytuya send them as is.
+    """
+
+    key = (dev.id, getattr(dev, 'cid', None), tuple(sorted(data.items())))
+    # sub-devices share the sequence numbers of their gateway
+    owner = getattr(dev, 'parent', None) or dev
+    now = time.monotonic()
+    with _frame_lock:
+        cached = _frame_cache.get(key)
+        if cached is not None:
+            _frame_cache.move_to_end(key)
+    if cached is None or now - cached[2] > FRAME_CACHE_TTL:
+        frame = owner._encode_message(generate(tinytuya.CONTROL, data))
+        _, _, cmd, _ = struct.unpack('>4I', frame[:16])
+        with _frame_lock:
+            _frame_cache[key] = (cmd, frame[16:-8], now)
+            _frame_cache.move_to_end(key)
+            while len(_frame_cache) > FRAME_CACHE_SIZE:
+                _frame_cache.popitem(last=False)
+        return frame
+
+    cmd, body, _ = cached
+    seqno = owner.seqno
+    owner.seqno += 1
+    header = struct.pack('>4I', 0x000055AA, seqno, cmd, len(body) + 8)
+    crc = binascii.crc32(header + body) & 0xFFFFFFFF
+    return header + body + struct.pack('>2I', crc, 0x0000AA55)
+
+
+def _shadow_key(device):
+    return getattr(device, 'id', None) or device
+
+
+def _same_value(field, reported, written):
+    """Return ``True`` if *reported* confirms the shadowed *written* value."""
+    if field == 'colour':
+        return (str(reported).lstrip('#').lower()
+                == str(written).lstrip('#').lower())
+    if field in ('bright', 'temp'):
+        return _coerce_level(reported) == _coerce_level(written)
+    return reported == written
+
+
+def _record_status(device, status):
+    """Store the ``dps`` reported in *status* as the shadow of *device*.
+
+    Pending writes confirmed by the report, or older than ``SHADOW_TTL``,
+    are dropped; the rest keep overriding the reported values.
+    """
+
+    if not isinstance(status, dict) or 'dps' not in status:
+        return
+    dps = status['dps']
+    now = time.monotonic()
+    with _shadow_lock:
+        key = _shadow_key(device)
+        entry = _shadow.setdefault(key, {'pending': {}})
+        entry['dps'] = dict(dps)
+        entry['at'] = now
+        if dps and key not in _profiles:
+            _profiles[key] = _learn_profile(
+                dps, _device_type(key) in (None, 'bulb'))
+        pending = entry['pending']
+        for field, (value, written_at) in list(pending.items()):
+            dps_key = _find_key(dps, _SHADOW_KEYS[field][0])
+            if now - written_at > SHADOW_TTL or (
+                    dps_key is not None
+                    and _same_value(field, dps[dps_key], value)):
+                del pending[field]
+
+
+def _remember_write(device, result, **fields):
+    """Record *fields* as written to *device* unless *result* is an error."""
+
+    if isinstance(result, dict) and 'Error' in result:
+        return
+    _remember_fields(_shadow_key(device), fields)
+
+
+def _remember_fields(key, fields):
+    now = time.monotonic()
+    with _shadow_lock:
+        entry = _shadow.setdefault(key, {'pending': {}})
+        for field, value in fields.items():
+            entry['pending'][field] = (value, now)
+
+
+def _read_dps(device, max_age=None):
+    """Return the ``dps`` of *device* with pending writes applied.
+
+    The last report is reused if it is younger than *max_age* seconds
+    (``SHADOW_MAX_AGE`` by default); otherwise the device is polled.
+    """
+
+    if max_age is None:
+        max_age = SHADOW_MAX_AGE
+    key = _shadow_key(device)
+    with _shadow_lock:
+        entry = _shadow.get(key)
+        fresh = (entry is not None and 'dps' in entry
+                 and time.monotonic() - entry['at'] <= max_age)
+    if not fresh:
+        _record_status(device, device.status())
+
+    now = time.monotonic()
+    with _shadow_lock:
+        entry = _shadow.get(key, {'pending': {}})
+        dps = dict(entry.get('dps', {}))
+        for field, (value, written_at) in list(entry['pending'].items()):
+            if now - written_at > SHADOW_TTL:
+                del entry['pending'][field]
+                continue
+            candidates, default = _SHADOW_KEYS[field]
+            dps_key = _find_key(dps, candidates)
+            dps[default if dps_key is None else dps_key] = value
+    return dps
+
+
+def _hsv_hex(r, g, b, encoding='hsv'):
+    """Return ``r, g, b`` encoded as a Tuya colour string.
+
+    ``encoding`` is ``'hsv'`` for ``hhhhssssvvvv`` (h: 0-360, s/v: 0-1000)
+    or ``'rgbhsv'`` for the older ``rrggbb0hhhssvv`` (s/v: 0-255) format.
+    Values are truncated like tinytuya does, so the string matches what the
+    device echoes back.
+    """
+    h, s, v = colorsys.rgb_to_hsv(r / 255, g / 255, b / 255)
+    if encoding == 'rgbhsv':
+        return '%02x%02x%02x0%03x%02x%02x' % (
+            r, g, b, int(h * 360), int(s * 255), int(v * 255))
+    return '%04x%04x%04x' % (int(h * 360), int(s * 1000), int(v * 1000))
+
+
+@functools.lru_cache(maxsize=None)
+def _scale_table(src_max, lo, hi):
+    """Return a table mapping ``0..src_max`` linearly onto ``lo..hi``."""
+    return tuple(round(lo + i * (hi - lo) / src_max) for i in range(src_max + 1))
+
+
+@functools.lru_cache(maxsize=None)
+def _kelvin_table(temp_range):
+    """Return native colour temperatures for ``KELVIN_MIN..KELVIN_MAX``."""
+    lo, hi = temp_range
+    span = KELVIN_MAX - KELVIN_MIN
+    return tuple(round(lo + (k - KELVIN_MIN) * (hi - lo) / span)
+                 for k in range(KELVIN_MIN, KELVIN_MAX + 1))
+
+
+# tinytuya bulb types mapped to the variant of their DP layout
+_BULB_TYPES = {'A': 'v1', 'B': 'v2', 'C': 'v1'}
+
+
+def _bulb_variant(dps):
+    """Return ``'v2'``, ``'v1'`` or ``None`` from the DP layout of *dps*.
+
+    Named DPs decide first; otherwise bulbs using the 20-series ids
+    (switch 20, mode 21, ..., bright 25, temp 26) are v2 firmware and those
+    using the 1-series ids (mode 2, bright 3, temp 4, colour 5) are v1.
+    Only meaningful for bulbs: other devices reuse these ids for other DPs.
+    """
+    if _find_key(dps, ('bright_value_v2', 'temp_value_v2')) is not None:
+        return 'v2'
+    if _find_key(dps, ('bright_value', 'temp_value')) is not None:
+        return 'v1'
+    if _find_key(dps, (20, 21, 22, 23, 24, 25, 26)) is not None:
+        return 'v2'
+    if _find_key(dps, (2, 3, 4, 5)) is not None:
+        return 'v1'
+    return None
+
+
+def _learn_profile(dps, bulb=True, variant=None):
+    """Return the capability profile implied by the reported *dps*.
+
+    The profile holds the native ``bright`` and ``temp`` ranges (``None``
+    when the DP layout gives no hint or the device is not a *bulb*), the
+    ``colour`` string encoding, and precomputed tables converting Kelvin
+    (``kelvin``) and the 0-1000 colour value (``colour_v``) to native
+    levels.  A known *variant* overrides the one implied by *dps*.
+    """
+
+    if variant is None and bulb:
+        variant = _bulb_variant(dps)
+    if variant == 'v2':
+        bright, temp, colour = (10, 1000), (0, 1000), 'hsv'
+    elif variant == 'v1':
+        bright, temp, colour = (25, 255), (0, 255), 'rgbhsv'
+    else:
+        bright = temp = None
+        colour = 'hsv'
+        colour_key = _find_key(dps, _SHADOW_KEYS['colour'][0])
+        if colour_key is not None and isinstance(dps[colour_key], str):
+            if len(dps[colour_key].lstrip('#').replace(' ', '')) == 14:
+                colour = 'rgbhsv'
+
+    return {
+        'bright': bright,
+        'temp': temp,
+        'colour': colour,
+        'kelvin': _kelvin_table(temp) if temp else None,
+        'colour_v': _scale_table(1000, 0, bright[1]) if bright else None,
+    }
+
+
+def _device_type(key):
+    """Return the configured type of the device shadowed as *key*."""
+    for cfg in devices.values():
+        if cfg.get('gwid') == key:
+            return cfg['type']
+    return None
+
+
+def device_profile(device, poll=True):
+    """Return the cached capability profile of *device*.
+
+    The profile is learned from the first status report of the device,
+    which is requested if needed unless *poll* is ``False``.  If no report
+    is available a default profile is returned but not cached.
+    """
+
+    key = _shadow_key(device)
+    if poll and key not in _profiles:
+        _read_dps(device)
+    return _profiles.get(key) or _learn_profile({})
+
+
+def _colour_level(profile, value):
+    """Convert a 0-1000 colour *value* to the native brightness scale."""
+    table = profile['colour_v']
+    if table is None or not isinstance(value, int) or not 0 <= value <= 1000:
+        return value
+    return table[value]
+
+
+def _clamp(value, native_range):
+    if native_range is None or not isinstance(value, int):
+        return value
+    lo, hi = native_range
+    return max(lo, min(hi, value))
+
+
+def kelvin_to_temp(device, kelvin):
+    """Return the native colour temperature of *device* for *kelvin*.
+
+    Devices with an unknown temperature range get the legacy mired value.
+    """
+    table = device_profile(device)['kelvin']
+    if table is None:
+        return int(1_000_000 / kelvin)
+    kelvin = max(KELVIN_MIN, min(KELVIN_MAX, kelvin))
+    return table[kelvin - KELVIN_MIN]
+
+
+def _switch(device, on, nowait=False):
+    """Turn *device* on or off and shadow the new switch state."""
+
+    method = device.turn_on if on else device.turn_off
+    if nowait:
+        try:
+            result = method(switch=True, nowait=True)
+        except TypeError:
+            result = method()
+    else:
+        result = method()
+    _remember_write(device, result, on=on)
+    return result
+
+
+def _call(method, *args, nowait=False):
+    return method(*args, nowait=True) if nowait else method(*args)
+
+
+def _set_colour(device, r, g, b, nowait=False):
+    result = _call(device.set_colour, r, g, b, nowait=nowait)
+    profile = device_profile(device, poll=not nowait)
+    colour = _hsv_hex(r, g, b, profile['colour'])
+    _remember_write(device, result, mode='colour', colour=colour)
+    return result
+
+
+def _set_brightness(device, level, nowait=False):
+    level = _clamp(level, device_profile(device, poll=not nowait)['bright'])
+    result = _call(device.set_brightness, level, nowait=nowait)
+    _remember_write(device, result, bright=level)
+    return result
+
+
+def _set_colourtemp(device, temp, nowait=False):
+    temp = _clamp(temp, device_profile(device, poll=not nowait)['temp'])
+    result = _call(device.set_colourtemp, temp, nowait=nowait)
+    _remember_write(device, result, temp=temp)
+    return result
+
+
 def current_hsv(device):
     """Return the current colour of *device* as an HSV tuple.
 
@@ -70,7 +591,7 @@ def current_hsv(device):
     0-360° and ``s``/``v`` in ``0..1``).
     """
 
-    status = device.status().get('dps', {})
+    status = _read_dps(device)
     print(f"[DEBUG] Device status dps: {status}")
     colour = None
     for key in ("colour", "color", "colour_data", "color_data", "24", 24):
@@ -103,7 +624,7 @@ def current_hsv(device):
 
     if isinstance(colour, str):
         hexstr = colour.lstrip('#').replace(' ', '')
-        if len(hexstr) >= 12:
+        if len(hexstr) >= 12 and len(hexstr) != 14:
             # "hhhhssssvvvv" (h:0-360, s:0-1000, v:0-1000)
             try:
                 h = int(hexstr[0:4], 16) / 360.0
@@ -136,7 +657,7 @@ def current_rgb(device):
 def current_brightness(device):
     """Return the current brightness level and mode of *device*."""
 
-    status = device.status().get('dps', {})
+    status = _read_dps(device)
     mode_key = _find_key(status, ('mode', 21))
     mode = status.get(mode_key, 'colour')
 
@@ -148,6 +669,7 @@ def current_brightness(device):
         parsed_val = None
         if col_key is not None:
             _, _, _, parsed_val = _parse_colour_str(status[col_key])
+            parsed_val = _colour_level(device_profile(device), parsed_val)
 
         val_key = _find_key(status, (
             'bright', 'brightness', 'value', 'bright_value', 'bright_value_v2', 25
@@ -173,11 +695,15 @@ def current_brightness(device):
 
 
 def adjust_brightness(device, delta):
-    """Adjust *device* brightness by *delta* within 0..256."""
+    """Adjust *device* brightness by *delta* within its brightness range.
+
+    Devices whose range is unknown are limited to ``0..MAX_BRIGHTNESS``.
+    """
 
     level, mode = current_brightness(device)
-    new_level = max(0, min(MAX_BRIGHTNESS, level + delta))
-    device.set_brightness(new_level)
+    lo, hi = device_profile(device)['bright'] or (0, MAX_BRIGHTNESS)
+    new_level = max(lo, min(hi, level + delta))
+    _set_brightness(device, new_level)
     print(f"[DEBUG] adjust_brightness {level} + {delta} -> {new_level}")
     return new_level, mode
 
@@ -238,7 +764,8 @@ def _parse_colour_str(colour):
 
     hexstr = colour.lstrip('#').replace(' ', '')
 
-    if len(hexstr) >= 12:
+    # 14 digit strings are ``rrggbb0hhhssvv`` and parsed as RGB below
+    if len(hexstr) >= 12 and len(hexstr) != 14:
         try:
             h = int(hexstr[0:4], 16) / 360.0
             s = int(hexstr[4:8], 16) / 1000.0
@@ -265,13 +792,28 @@ def _parse_colour_str(colour):
     return None, None, None, None
 
 
+@_traced
 def get_all_states():
     """Return the current state of all configured devices."""
 
+    if SHARD_WORKERS > 1 and _sessions is None:
+        # workers overlay the writes made in this process on their reports
+        writes = _shard_writes(devices)
+        merged = {}
+        for states in _run_sharded(_collect_shard, shard_devices(), writes):
+            merged.update(states)
+        return {name: merged[name] for name in devices if name in merged}
+    return _collect_states(devices)
+
+
+def _collect_states(names):
+    """Return the current state of each device in *names*."""
+
     states = {}
-    for name, cfg in devices.items():
+    for name in names:
+        cfg = devices[name]
         dev = get_device(name)
-        dps = dev.status().get('dps', {})
+        dps = _read_dps(dev)
         state = {}
         key = _find_key(dps, ('switch', '1', 20))
         if key is not None:
@@ -289,6 +831,7 @@ def get_all_states():
                     colour_val = dps[col_key]
                     state['color'] = colour_val
                     _, _, _, parsed_val = _parse_colour_str(colour_val)
+                    parsed_val = _colour_level(device_profile(dev), parsed_val)
 
                 val_key = _find_key(dps, (
                     'bright', 'brightness', 'value', 'bright_value',
@@ -308,19 +851,17 @@ def get_all_states():
                 ))
                 if bright_key is not None:
                     state['brightness'] = _coerce_level(dps[bright_key])
-                temp_key = _find_key(dps, ('temp', 'colourtemp', 'color_temp',
-                                          26))
+                temp_key = _find_key(dps, _SHADOW_KEYS['temp'][0])
                 if temp_key is not None:
                     state['temp'] = dps[temp_key]
         states[name] = state
     return states
 
 
+@_traced
 def save_preset(name):
     """Save the current state of all devices to *name*.json."""
 
-    import json
-
     states = get_all_states()
     print(f"[DEBUG] Preset states gathered: {states}")
     for state in states.values():
@@ -334,8 +875,12 @@ def save_preset(name):
     print(f"[DEBUG] Saved preset to {filename}")
 
 
-def _apply_state(dev_name, state):
-    """Helper to apply ``state`` to ``dev_name``."""
+def _apply_state(dev_name, state, nowait=False):
+    """Helper to apply ``state`` to ``dev_name``.
+
+    With *nowait* colour and brightness changes are sent without waiting
+    for the device to respond.
+    """
 
     print(f"[DEBUG] Applying state for {dev_name}: {state}")
     if dev_name not in devices:
@@ -344,22 +889,23 @@ def _apply_state(dev_name, state):
     if cfg['type'] == 'plug' and not UPDATE_PLUGS_ON_PRESET_LOAD:
         return
     dev = get_device(dev_name)
+    if (nowait and cfg['type'] == 'bulb'
+            and not getattr(dev, 'bulb_configured', True)):
+        # tinytuya cannot send bulb commands without waiting until it knows
+        # the DP layout, so sub-devices without a ``bulb_type`` are polled
+        _record_status(dev, dev.status())
     if 'on' in state:
-        try:
-            if state['on']:
-                dev.turn_on(switch=True, nowait=True)
-            else:
-                dev.turn_off(switch=True, nowait=True)
-        except TypeError:
-            (dev.turn_on if state['on'] else dev.turn_off)()
+        _switch(dev, state['on'], nowait=True)
     if cfg['type'] == 'bulb':
         mode = state.get('mode')
         if mode in ('colour', 'color'):
             colour = state.get('color')
             r, g, b, default_val = _parse_colour_str(colour)
+            default_val = _colour_level(device_profile(dev, poll=not nowait),
+                                        default_val)
             if r is not None:
                 print(f"[DEBUG] Loading colour {r,g,b} on {dev_name}")
-                dev.set_colour(r, g, b)
+                _set_colour(dev, r, g, b, nowait)
             if hasattr(dev, 'set_brightness'):
                 if 'value' in state:
                     val = _coerce_level(state['value'])
@@ -369,84 +915,301 @@ def _apply_state(dev_name, state):
                     val = default_val
                 if val is not None:
                     print(f"[DEBUG] Loading brightness {val} on {dev_name}")
-                    dev.set_brightness(val)
+                    _set_brightness(dev, val, nowait)
         else:
             if 'brightness' in state and hasattr(dev, 'set_brightness'):
                 bright = _coerce_level(state['brightness'])
                 print(f"[DEBUG] Loading brightness {bright} on {dev_name}")
-                dev.set_brightness(bright)
+                _set_brightness(dev, bright, nowait)
             if 'temp' in state:
                 print(f"[DEBUG] Loading colour temperature {state['temp']} on {dev_name}")
-                dev.set_colourtemp(state['temp'])
+                _set_colourtemp(dev, state['temp'], nowait)
 
 
+@_traced
 def load_preset(name):
     """Load the preset stored in *name*.json and apply it."""
 
-    import json
-    from concurrent.futures import ThreadPoolExecutor
-
     filename = f"{name}.json"
     with open(filename) as fh:
         states = json.load(fh)
     print(f"[DEBUG] Loaded preset from {filename}: {states}")
 
-    with ThreadPoolExecutor() as executor:
-        for dev_name, state in states.items():
-            executor.submit(_apply_state, dev_name, state)
+    if SHARD_WORKERS > 1 and _sessions is None:
+        shards = shard_devices([n for n in states if n in devices])
+        for writes in _run_sharded(
+                _apply_shard,
+                [{n: states[n] for n in shard} for shard in shards]):
+            _merge_shard_writes(writes)
+        return
+    _apply_states(states)
 
 
-if __name__ == '__main__':
-    if len(sys.argv) < 2:
+def _apply_states(states):
+    """Apply each of *states* concurrently.
+
+    Sub-devices behind the same hub share its socket, so they are applied
+    in a single task that pipelines their commands without waiting.
+    """
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    batches = {}
+    for dev_name, state in states.items():
+        hub_ip = _gateway_ip(dev_name) if dev_name in devices else None
+        key = ('gateway', hub_ip) if hub_ip else ('device', dev_name)
+        batches.setdefault(key, []).append((dev_name, state))
+
+    with ThreadPoolExecutor() as executor:
+        for (kind, _), batch in batches.items():
+            executor.submit(_apply_batch, batch, kind == 'gateway')
+
+
+def _apply_batch(batch, nowait):
+    for dev_name, state in batch:
+        _apply_state(dev_name, state, nowait)
+
+
+@_traced
+def switch_all(on):
+    """Turn every configured device on or off, sharded across workers.
+
+    Returns the names of the devices that were switched.
+    """
+
+    if SHARD_WORKERS > 1 and _sessions is None:
+        shards = shard_devices()
+        for writes in _run_sharded(_switch_shard, shards, on):
+            _merge_shard_writes(writes)
+        switched = {name for shard in shards for name in shard}
+        return [name for name in devices if name in switched]
+    return _switch_devices(list(devices), on)
+
+
+def _switch_devices(names, on):
+    for name in names:
+        _switch(get_device(name), on, nowait=True)
+    return names
+
+
+def _collect_shard(names, writes):
+    _merge_shard_writes({n: writes[n] for n in names if n in writes})
+    return _collect_states(names)
+
+
+def _apply_shard(states):
+    started = time.monotonic()
+    _apply_states(states)
+    return _shard_writes(states, started)
+
+
+def _switch_shard(names, on):
+    started = time.monotonic()
+    _switch_devices(names, on)
+    return _shard_writes(names, started)
+
+
+def _device_key(name):
+    """Return the shadow key of device *name*, or ``None`` if unknown."""
+
+    dev = _sessions.get(name) if _sessions is not None else None
+    if dev is not None:
+        return _shadow_key(dev)
+    return devices[name].get('gwid')
+
+
+def _shard_writes(names, since=None):
+    """Return the pending shadow writes to *names* made since *since*.
+
+    Writes are returned as ``{name: {field: (value, age)}}`` so that the
+    receiving process can keep their original timestamps.
+    """
+
+    writes = {}
+    now = time.monotonic()
+    with _shadow_lock:
+        for name in names:
+            key = _device_key(name)
+            entry = _shadow.get(key) if key is not None else None
+            if not entry:
+                continue
+            fields = {
+                field: (value, now - written_at)
+                for field, (value, written_at) in entry['pending'].items()
+                if since is None or written_at >= since
+            }
+            if fields:
+                writes[name] = fields
+    return writes
+
+
+def _merge_shard_writes(writes):
+    """Shadow *writes* made by another process (see :func:`_shard_writes`).
+
+    A write never replaces a newer pending write to the same field.
+    """
+
+    now = time.monotonic()
+    with _shadow_lock:
+        for name, fields in writes.items():
+            key = _device_key(name)
+            if key is None:
+                continue
+            pending = _shadow.setdefault(key, {'pending': {}})['pending']
+            for field, (value, age) in fields.items():
+                written_at = now - age
+                if field not in pending or pending[field][1] < written_at:
+                    pending[field] = (value, written_at)
+
+
+def shard_devices(names=None, shards=None, by=None):
+    """Partition *names* (default: all devices) into *shards* lists.
+
+    Devices are grouped by IP so that sub-devices behind a hub share a
+    worker.  With ``by='subnet'`` whole /24 networks are kept together and
+    handed to the least loaded shard; with ``by='hash'`` each IP is placed
+    by a stable CRC32 hash, so a device keeps its shard between calls.
+    Some shards may be empty.
+    """
+
+    if names is None:
+        names = list(devices)
+    if shards is None:
+        shards = SHARD_WORKERS
+    if by is None:
+        by = SHARD_BY
+    shards = max(1, shards)
+
+    if by == 'subnet':
+        groups = {}
+        for name in names:
+            subnet = devices[name]['ip'].rsplit('.', 1)[0]
+            groups.setdefault(subnet, []).append(name)
+        parts = [[] for _ in range(shards)]
+        for group in sorted(groups.values(), key=len, reverse=True):
+            min(parts, key=len).extend(group)
+    elif by == 'hash':
+        parts = [[] for _ in range(shards)]
+        for name in names:
+            ip = devices[name]['ip'].encode()
+            parts[zlib.crc32(ip) % shards].append(name)
+    else:
+        raise ValueError(f"Unknown shard mode: {by}")
+    return parts
+
+
+def _init_shard_worker():
+    global _sessions
+    _sessions = {}
+
+
+def _run_sharded(func, shards, *args):
+    """Run ``func(shard, *args)`` for each non-empty shard in a worker.
+
+    Shard ``i`` always goes to worker process ``i`` so that workers keep
+    their device sessions open between calls.  Returns the results of the
+    non-empty shards in order.
+    """
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    while len(_shard_executors) < len(shards):
+        _shard_executors.append(
+            ProcessPoolExecutor(1, initializer=_init_shard_worker))
+    futures = [
+        executor.submit(func, shard, *args)
+        for executor, shard in zip(_shard_executors, shards)
+        if shard
+    ]
+    return [future.result() for future in futures]
+
+
+def _reset_state():
+    """Forget all cached device state, as a freshly started process would.
+
+    Clears the shadow state, learned profiles and cached frames, and closes
+    gateway sessions and shard workers.
+    """
+
+    with _shadow_lock:
+        _shadow.clear()
+        _profiles.clear()
+    with _frame_lock:
+        _frame_cache.clear()
+    with _gateway_lock:
+        for hub in _gateways.values():
+            if hasattr(hub, 'close'):
+                hub.close()
+        _gateways.clear()
+        _sub_devices.clear()
+    for executor in _shard_executors:
+        executor.shutdown()
+    del _shard_executors[:]
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    if len(argv) < 2:
         usage()
 
-    cmd = sys.argv[1].lower()
+    cmd = argv[1].lower()
 
-    if cmd == 'save_preset' and len(sys.argv) == 3:
-        save_preset(sys.argv[2])
+    if cmd == 'save_preset' and len(argv) == 3:
+        save_preset(argv[2])
         sys.exit(0)
 
-    if cmd == 'load_preset' and len(sys.argv) == 3:
-        load_preset(sys.argv[2])
+    if cmd == 'load_preset' and len(argv) == 3:
+        load_preset(argv[2])
         sys.exit(0)
 
     if cmd in ('all_on', 'allon', 'alloff', 'all_off'):
-        action = 'turn_on' if 'on' in cmd else 'turn_off'
-        global_action(lambda d, n: getattr(d, action)(switch=True, nowait=True) or print(f"{n} {action}"))
+        record_invocation(cmd)
+        on = 'on' in cmd
+        action = 'turn_on' if on else 'turn_off'
+        if SHARD_WORKERS > 1:
+            # recorded above as the CLI verb
+            with _trace_scope():
+                switched = switch_all(on)
+            for n in switched:
+                print(f"{n} {action}")
+            sys.exit(0)
+        global_action(lambda d, n: _switch(d, on, nowait=True) or print(f"{n} {action}"))
 
-    if len(sys.argv) < 3:
+    if len(argv) < 3:
         usage()
 
-    raw = sys.argv[1]
+    raw = argv[1]
     try:
         name = resolve_name(raw)
     except KeyError as e:
         print(e)
         sys.exit(1)
 
-    action = sys.argv[2].lower()
+    action = argv[2].lower()
+    record_invocation(action, name, argv[3:])
     device = get_device(name)
 
     if action == 'on':
-        device.turn_on()
+        _switch(device, True)
         print(f"{name} on")
 
     elif action == 'off':
-        device.turn_off()
+        _switch(device, False)
         print(f"{name} off")
 
     elif action == 'hsv':
-        if len(sys.argv) != 6:
+        if len(argv) != 6:
             usage()
-        h, s, v = map(int, sys.argv[3:6])
+        h, s, v = map(int, argv[3:6])
         r, g, b = colorsys.hsv_to_rgb(h / 360, s / 100, v / 100)
-        device.set_colour(int(r * 255), int(g * 255), int(b * 255))
+        _set_colour(device, int(r * 255), int(g * 255), int(b * 255))
         print(f"{name} HSV({h},{s},{v})")
 
     elif action in ('h', 'hue', 's', 'sat', 'v', 'val'):
-        if len(sys.argv) != 4:
+        if len(argv) != 4:
             usage()
-        new_val = int(sys.argv[3])
+        new_val = int(argv[3])
         h, s, v = current_hsv(device)
         if action in ('h', 'hue'):
             h = new_val / 360
@@ -455,41 +1218,45 @@ if __name__ == '__main__':
         else:
             v = new_val / 100
         r, g, b = colorsys.hsv_to_rgb(h, s, v)
-        device.set_colour(int(r * 255), int(g * 255), int(b * 255))
+        _set_colour(device, int(r * 255), int(g * 255), int(b * 255))
         print(f"{name} HSV({int(h * 360)},{int(s * 100)},{int(v * 100)})")
 
     elif action == 'temp':
-        if len(sys.argv) != 4:
+        if len(argv) != 4:
             usage()
-        k = int(sys.argv[3])
-        m = int(1_000_000 / k)
+        k = int(argv[3])
+        m = kelvin_to_temp(device, k)
         try:
-            device.set_colourtemp(m)
+            _set_colourtemp(device, m)
             print(f"{name} {k}K")
         except Exception as e:
             print(f"Failed to set color temperature on {name}: {e}")
             sys.exit(1)
 
     elif action in ('bright', 'brightness'):
-        if len(sys.argv) != 4 or not hasattr(device, 'set_brightness'):
+        if len(argv) != 4 or not hasattr(device, 'set_brightness'):
             usage()
-        b = int(sys.argv[3])
-        device.set_brightness(b)
+        b = _clamp(int(argv[3]), device_profile(device)['bright'])
+        _set_brightness(device, b)
         print(f"{name} brightness {b}%")
 
     elif action == 'brightenby':
-        delta = int(sys.argv[3])
+        delta = int(argv[3])
         new_bright, _ = adjust_brightness(device, delta)
         print(f"{name} brightness {new_bright}")
 
     elif action == 'dimby':
-        delta = int(sys.argv[3])
+        delta = int(argv[3])
         new_bright, _ = adjust_brightness(device, -delta)
         print(f"{name} brightness {new_bright}")
 
     elif action == 'get':
-        status = device.status().get('dps', {})
+        status = _read_dps(device, max_age=0)
         print(name, status)
 
     else:
         usage()
+
+
+if __name__ == '__main__':
+    main()
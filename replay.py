@@ -0,0 +1,265 @@
+"""Replay recorded ``light_control`` invocations and report their performance.
+
+Record a trace by setting ``LIGHT_CONTROL_TRACE`` to a file name while using
+the CLI or API, then replay it::
+
+    LIGHT_CONTROL_TRACE=trace.jsonl python light_control.py Lamp on
+    python replay.py trace.jsonl --speed 10 --simulate
+
+Each trace line is a JSON object with ``ts``, ``verb``, ``device`` and
+``args`` fields (plus ``kwargs`` for API calls made with keywords).
+Invocations are replayed with their original spacing divided by ``--speed``
+(``0`` replays them back to back), either against the real devices or
+against a simulated device farm.
+
+In production every CLI invocation is a new process, so by default all
+cached device state is dropped before each CLI entry is replayed.  As that
+would disturb invocations still in flight, traces with CLI entries can only
+be replayed with ``--concurrency 1`` unless ``--warm`` is passed to keep the
+state, as a long running API user would.
+"""
+
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+import light_control
+
+# API functions that are recorded under their own name.
+API_VERBS = ('get_all_states', 'save_preset', 'load_preset', 'switch_all')
+
+
+class SimulatedDevice:
+    """In-memory stand-in for a tinytuya bulb or plug.
+
+    State lives in the owning :class:`SimulatedFarm` so it survives
+    :func:`light_control.get_device` creating a new object per call.
+    """
+
+    def __init__(self, farm, dev_id, address=None, local_key='', cid=None,
+                 parent=None):
+        self.farm = farm
+        self.id = dev_id
+        self.address = address
+        self.local_key = local_key
+        self.cid = cid
+        self.parent = parent
+
+    def set_socketPersistent(self, persist):
+        pass
+
+    def set_version(self, version):
+        pass
+
+    def status(self):
+        return self.farm.request(self.id, None)
+
+    def turn_on(self, switch=True, nowait=False):
+        return self.farm.request(self.id, {'20': True}, nowait)
+
+    def turn_off(self, switch=True, nowait=False):
+        return self.farm.request(self.id, {'20': False}, nowait)
+
+    def set_colour(self, r, g, b, nowait=False):
+        colour = light_control._hsv_hex(r, g, b)
+        return self.farm.request(self.id, {'21': 'colour', '24': colour},
+                                 nowait)
+
+    def set_brightness(self, brightness, nowait=False):
+        return self.farm.request(self.id, {'25': brightness}, nowait)
+
+    def set_colourtemp(self, colourtemp, nowait=False):
+        return self.farm.request(self.id, {'21': 'white', '26': colourtemp},
+                                 nowait)
+
+
+class SimulatedFarm:
+    """A set of simulated devices with configurable latency and failures."""
+
+    def __init__(self, latency=0.02, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.states = {}
+        self.lock = threading.Lock()
+
+    def device(self, *args, **kwargs):
+        return SimulatedDevice(self, *args, **kwargs)
+
+    def request(self, dev_id, dps, nowait=False):
+        """Apply *dps* to *dev_id* (or just query it) like a real device."""
+
+        if not nowait and self.latency:
+            time.sleep(self.random.uniform(0.5, 1.5) * self.latency)
+        with self.lock:
+            if self.random.random() < self.error_rate:
+                if nowait:
+                    return None
+                return {'Error': 'Network Error: Device Unreachable',
+                        'Err': '905', 'Payload': None}
+            state = self.states.setdefault(
+                dev_id, {'20': False, '21': 'white', '24': '000003e803e8',
+                         '25': 1000, '26': 500})
+            if dps:
+                state.update(dps)
+                return None if nowait else {'dps': dict(dps)}
+            return {'dps': dict(state)}
+
+    def install(self):
+        """Route :func:`light_control.get_device` to this farm."""
+        light_control.device_class = {
+            'bulb': self.device,
+            'plug': self.device,
+            'gateway': self.device,
+        }
+
+
+def load_trace(path):
+    """Return the invocations recorded in *path* sorted by timestamp."""
+
+    entries = []
+    with open(path) as fh:
+        for line in fh:
+            line = line.strip()
+            if line:
+                entries.append(json.loads(line))
+    entries.sort(key=lambda entry: entry['ts'])
+    return entries
+
+
+def _is_cli(entry):
+    return entry.get('device') is not None or entry['verb'] not in API_VERBS
+
+
+def invoke(entry, warm=False):
+    """Run a single trace *entry*, raising if it failed.
+
+    Unless *warm*, CLI entries start from a cold cache like a new process.
+    """
+
+    verb, device, args = entry['verb'], entry.get('device'), entry['args']
+    if not _is_cli(entry):
+        getattr(light_control, verb)(*args, **entry.get('kwargs', {}))
+        return
+    if not warm:
+        light_control._reset_state()
+    argv = ['light_control.py']
+    if device is not None:
+        argv.append(device)
+    argv.append(verb)
+    argv.extend(str(arg) for arg in args)
+    try:
+        light_control.main(argv)
+    except SystemExit as e:
+        if e.code:
+            raise RuntimeError(f"exit status {e.code}") from None
+
+
+def _timed(entry, warm):
+    start = time.perf_counter()
+    try:
+        invoke(entry, warm)
+    except Exception:
+        ok = False
+    else:
+        ok = True
+    return time.perf_counter() - start, ok
+
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = round(pct / 100 * (len(sorted_values) - 1))
+    return sorted_values[index]
+
+
+def replay(entries, speed=1.0, concurrency=1, warm=False):
+    """Replay *entries* and return a summary of the run.
+
+    Invocations are started on schedule (open loop), so a slow device shows
+    up as latency rather than as a slower request rate, unless all
+    *concurrency* workers are busy.  See :func:`invoke` for *warm*; cold
+    CLI entries reset shared state, so they need a *concurrency* of 1.
+    """
+
+    if not warm and concurrency > 1 and any(map(_is_cli, entries)):
+        raise ValueError("cold CLI entries cannot be replayed concurrently")
+    previous_trace = light_control.TRACE_FILE
+    light_control.TRACE_FILE = None
+    results = []
+    try:
+        with contextlib.redirect_stdout(None), \
+                ThreadPoolExecutor(max(1, concurrency)) as executor:
+            futures = []
+            start = time.perf_counter()
+            first_ts = entries[0]['ts'] if entries else 0
+            for entry in entries:
+                if speed > 0:
+                    due = start + (entry['ts'] - first_ts) / speed
+                    delay = due - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                futures.append(executor.submit(_timed, entry, warm))
+            results = [future.result() for future in futures]
+            elapsed = time.perf_counter() - start
+    finally:
+        light_control.TRACE_FILE = previous_trace
+
+    latencies = sorted(latency for latency, _ in results)
+    errors = sum(1 for _, ok in results if not ok)
+    return {
+        'requests': len(results),
+        'errors': errors,
+        'error_rate': errors / len(results) if results else 0.0,
+        'elapsed': elapsed,
+        'throughput': len(results) / elapsed if elapsed > 0 else 0.0,
+        'p50': _percentile(latencies, 50),
+        'p95': _percentile(latencies, 95),
+        'p99': _percentile(latencies, 99),
+        'max': latencies[-1] if latencies else 0.0,
+    }
+
+
+def print_report(summary):
+    print(f"requests:   {summary['requests']}")
+    print(f"errors:     {summary['errors']} ({summary['error_rate']:.2%})")
+    print(f"elapsed:    {summary['elapsed']:.3f}s")
+    print(f"throughput: {summary['throughput']:.1f} req/s")
+    for key in ('p50', 'p95', 'p99', 'max'):
+        print(f"{key + ':':<11} {summary[key] * 1000:.1f} ms")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('trace', help='JSON lines trace to replay')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='speed-up factor, 0 to replay back to back')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='maximum invocations in flight')
+    parser.add_argument('--warm', action='store_true',
+                        help='keep cached device state between CLI entries')
+    parser.add_argument('--simulate', action='store_true',
+                        help='replay against a simulated device farm')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='simulated round trip time in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of simulated requests that fail')
+    args = parser.parse_args(argv)
+
+    if args.simulate:
+        SimulatedFarm(args.latency, args.error_rate).install()
+    try:
+        summary = replay(load_trace(args.trace), args.speed,
+                         args.concurrency, args.warm)
+    except ValueError as e:
+        parser.error(f"{e}; pass --warm or --concurrency 1")
+    print_report(summary)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
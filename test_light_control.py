@@ -1,7 +1,12 @@
+import binascii
+import collections
 import colorsys
 import json
 import pytest
+import struct
 import sys
+import threading
+import time
 import types
 
 # Stub tinytuya before importing the module under test as it is not
@@ -9,6 +14,7 @@ import types
 tinytuya = types.ModuleType('tinytuya')
 tinytuya.BulbDevice = object
 tinytuya.OutletDevice = object
+tinytuya.Device = object
 sys.modules['tinytuya'] = tinytuya
 
 import light_control
@@ -261,7 +267,8 @@ def test_load_preset_can_ignore_plugs(tmp_path, monkeypatch):
 
 
 def test_brightenby_caps_at_256():
-    bulb = DummyBulb({'20': True, '21': 'colour', '25': '200'})
+    # no DP layout hint, so the legacy 0..MAX_BRIGHTNESS range applies
+    bulb = DummyBulb({'switch': True, 'mode': 'colour', 'bright': '200'})
 
     light_control.adjust_brightness(bulb, 100)
 
@@ -269,7 +276,7 @@ def test_brightenby_caps_at_256():
 
 
 def test_dimby_floors_at_0():
-    bulb = DummyBulb({'20': True, '21': 'white', 'bright': '100'})
+    bulb = DummyBulb({'switch': True, 'mode': 'white', 'bright': '100'})
 
     light_control.adjust_brightness(bulb, -200)
 
@@ -282,3 +289,564 @@ def test_dimby_uses_bright_value_v2(monkeypatch):
     light_control.adjust_brightness(bulb, -600)
 
     assert ('brightness', 200) in bulb.calls
+
+
+def test_current_hsv_reads_own_colour_write():
+    bulb = DummyBulb({'20': True, '21': 'colour', '24': '00b401f403e8'})
+
+    light_control.current_hsv(bulb)
+    light_control._set_colour(bulb, 255, 0, 0)
+    h, s, v = light_control.current_hsv(bulb)
+
+    assert ('colour', 255, 0, 0) in bulb.calls
+    assert (h, s, v) == pytest.approx((0, 1, 1))
+
+
+def test_shadow_reuses_recent_report():
+    bulb = DummyBulb({'20': True, '21': 'white', 'bright': '100'})
+    polls = []
+    status = bulb.status
+    bulb.status = lambda: polls.append(1) or status()
+
+    light_control.adjust_brightness(bulb, 50)
+    level, _ = light_control.current_brightness(bulb)
+
+    assert level == 150
+    assert len(polls) == 1
+
+
+def test_shadow_dropped_when_device_reports(monkeypatch):
+    bulb = DummyBulb({'20': True, '21': 'white', 'bright': '100'})
+    monkeypatch.setattr(light_control, 'SHADOW_MAX_AGE', 0)
+
+    light_control._set_brightness(bulb, 150)
+    bulb._status['dps']['bright'] = '150'
+    assert light_control.current_brightness(bulb)[0] == 150
+
+    bulb._status['dps']['bright'] = '90'
+    assert light_control.current_brightness(bulb)[0] == 90
+
+
+def test_colour_write_confirmed_by_tinytuya_encoding(monkeypatch):
+    bulb = DummyBulb({'20': True, '21': 'colour', '24': '00b401f403e8'})
+    monkeypatch.setattr(light_control, 'SHADOW_MAX_AGE', 0)
+
+    light_control._set_colour(bulb, 0, 128, 0)
+    bulb._status['dps']['24'] = '007803e801f5'
+    light_control.current_hsv(bulb)
+    bulb._status['dps']['24'] = '00f003e803e8'
+
+    assert light_control.current_hsv(bulb)[0] == pytest.approx(240 / 360)
+
+
+def test_failed_write_not_shadowed():
+    bulb = DummyBulb({'20': True, '21': 'white', 'bright': '100'})
+    bulb.set_brightness = lambda b: {'Error': 'Network Error'}
+
+    light_control._set_brightness(bulb, 200)
+
+    assert light_control.current_brightness(bulb)[0] == 100
+
+
+def test_shard_devices_keeps_shared_ip_together(monkeypatch):
+    devices = {
+        'A': {'ip': '10.0.0.1'}, 'B': {'ip': '10.0.0.1'},
+        'C': {'ip': '10.0.0.2'}, 'D': {'ip': '10.0.1.3'},
+        'E': {'ip': '10.0.2.4'},
+    }
+    monkeypatch.setattr(light_control, 'devices', devices)
+
+    for by in ('hash', 'subnet'):
+        shards = light_control.shard_devices(shards=3, by=by)
+        assert len(shards) == 3
+        assert sorted(n for shard in shards for n in shard) == list('ABCDE')
+        assert any({'A', 'B'} <= set(shard) for shard in shards)
+
+    shards = light_control.shard_devices(shards=3, by='subnet')
+    assert any({'A', 'B', 'C'} <= set(shard) for shard in shards)
+
+
+def test_sharded_get_all_states_and_load_preset(tmp_path, monkeypatch):
+    bulbs = {n: DummyBulb({'20': True, '21': 'colour', '24': '#ff0000', '25': '80'})
+             for n in ('One', 'Two', 'Three')}
+    devices = {n: {'type': 'bulb', 'ip': f'10.0.{i}.1'}
+               for i, n in enumerate(bulbs)}
+    shards_run = []
+
+    def run_sharded(func, shards, *args):
+        shards_run.append([s for s in shards if s])
+        return [func(s, *args) for s in shards if s]
+
+    monkeypatch.setattr(light_control, 'devices', devices)
+    monkeypatch.setattr(light_control, 'get_device', lambda n: bulbs[n])
+    monkeypatch.setattr(light_control, 'SHARD_WORKERS', 2)
+    monkeypatch.setattr(light_control, '_run_sharded', run_sharded)
+
+    states = light_control.get_all_states()
+    assert list(states) == ['One', 'Two', 'Three']
+    assert states['Two']['value'] == 80
+
+    preset_name = str(tmp_path / 'preset')
+    with open(preset_name + '.json', 'w') as fh:
+        json.dump({n: {'on': False} for n in bulbs}, fh)
+    light_control.load_preset(preset_name)
+
+    assert light_control.switch_all(True) == ['One', 'Two', 'Three']
+    assert all(b.calls == ['off', 'on'] for b in bulbs.values())
+    assert len(shards_run) == 3
+
+
+class DummyEncoder:
+    """Device exposing the tinytuya hooks used by the frame cache."""
+
+    def __init__(self):
+        self.id = 'dev'
+        self.seqno = 1
+        self.encoded = 0
+
+    def generate_payload(self, command, data=None):
+        return json.dumps({'t': 'now', 'dps': data}).encode()
+
+    def _encode_message(self, payload):
+        self.encoded += 1
+        body = b'3.3' + bytes(12) + payload[::-1]
+        header = struct.pack('>4I', 0x55AA, self.seqno, 7, len(body) + 8)
+        self.seqno += 1
+        crc = binascii.crc32(header + body) & 0xFFFFFFFF
+        return header + body + struct.pack('>2I', crc, 0xAA55)
+
+
+def test_frame_cache_reuses_encrypted_body(monkeypatch):
+    monkeypatch.setattr(light_control.tinytuya, 'CONTROL', 7, raising=False)
+    monkeypatch.setattr(light_control, '_frame_cache', collections.OrderedDict())
+    dev = DummyEncoder()
+    light_control._enable_frame_cache(dev)
+
+    first = dev.generate_payload(7, {'20': True})
+    second = dev.generate_payload(7, {'20': True})
+    other = dev.generate_payload(7, {'20': False})
+
+    assert dev.encoded == 2
+    assert dev.seqno == 4
+    assert first[16:-8] == second[16:-8]
+    assert first[4:8] != second[4:8]
+    assert other[16:-8] != first[16:-8]
+
+
+def test_frame_cache_frame_matches_fresh_encoding(monkeypatch):
+    monkeypatch.setattr(light_control.tinytuya, 'CONTROL', 7, raising=False)
+    monkeypatch.setattr(light_control, '_frame_cache', collections.OrderedDict())
+    dev = DummyEncoder()
+    fresh = DummyEncoder()
+    light_control._enable_frame_cache(dev)
+
+    dev.generate_payload(7, {'24': '00b401f403e8'})
+    cached = dev.generate_payload(7, {'24': '00b401f403e8'})
+    fresh.seqno = 2
+    expected = fresh._encode_message(
+        fresh.generate_payload(7, {'24': '00b401f403e8'}))
+
+    assert cached == expected
+    assert dev.generate_payload(10, None) == fresh.generate_payload(10, None)
+
+
+def test_profile_learned_once_from_first_report():
+    bulb = DummyBulb({'20': True, '21': 'white', 'bright_value': '200',
+                      'temp_value': '100'})
+    polls = []
+    status = bulb.status
+    bulb.status = lambda: polls.append(1) or status()
+
+    profile = light_control.device_profile(bulb)
+    bulb._status['dps'] = {'20': True, 'bright_value_v2': '900'}
+
+    assert profile['bright'] == (25, 255)
+    assert profile['temp'] == (0, 255)
+    assert light_control.device_profile(bulb) is profile
+    assert len(polls) == 1
+
+
+def test_brightness_clamped_to_v2_range():
+    bulb = DummyBulb({'20': True, '21': 'white', 'bright_value_v2': '800'})
+
+    light_control.adjust_brightness(bulb, 500)
+    light_control.adjust_brightness(bulb, -2000)
+
+    assert ('brightness', 1000) in bulb.calls
+    assert ('brightness', 10) in bulb.calls
+
+
+def test_kelvin_converted_to_native_scale():
+    v2 = DummyBulb({'20': True, '21': 'white', 'bright_value_v2': '500',
+                    'temp_value_v2': '0'})
+    unknown = DummyBulb({'switch': True, 'mode': 'white', 'bright': '100'})
+
+    assert light_control.kelvin_to_temp(v2, 2700) == 0
+    assert light_control.kelvin_to_temp(v2, 6500) == 1000
+    assert light_control.kelvin_to_temp(v2, 9000) == 1000
+    assert light_control.kelvin_to_temp(unknown, 4000) == 250
+    assert light_control.kelvin_to_temp(unknown, 2000) == 500
+
+
+def test_profile_follows_dp_layout_not_level():
+    dim = DummyBulb({'20': True, '21': 'white', '25': '200'})
+    bright = DummyBulb({'20': True, '21': 'white', '25': '800'})
+    v1 = DummyBulb({'1': True, '2': 'white', '3': '200', '4': '0'})
+
+    assert light_control.device_profile(dim)['bright'] == (10, 1000)
+    assert light_control.device_profile(bright)['bright'] == (10, 1000)
+    assert light_control.device_profile(v1)['bright'] == (25, 255)
+    assert light_control.device_profile(v1)['colour'] == 'rgbhsv'
+
+    light_control.adjust_brightness(dim, 500)
+    assert ('brightness', 700) in dim.calls
+
+
+def test_profile_only_learned_for_bulbs(monkeypatch):
+    plug = DummyRemote('meter')
+    plug.status = lambda: {'dps': {'1': True, '20': 2301}}
+    partial = DummyBulb({'25': '600'})
+    monkeypatch.setattr(light_control, 'devices',
+                        {'Meter': {'type': 'plug', 'gwid': 'meter'}})
+
+    assert light_control.device_profile(plug)['bright'] is None
+    assert light_control.device_profile(partial)['bright'] == (10, 1000)
+
+
+def test_cli_prints_brightness_sent(monkeypatch, capsys):
+    bulb = DummyBulb({'20': True, '21': 'white', '25': '500'})
+    monkeypatch.setattr(light_control, 'devices', {'Lamp': {}})
+    monkeypatch.setattr(light_control, 'get_device', lambda name: bulb)
+
+    light_control.main(['light_control.py', 'Lamp', 'bright', '5'])
+
+    assert bulb.calls == [('brightness', 10)]
+    assert capsys.readouterr().out.endswith('Lamp brightness 10%\n')
+
+
+def test_colour_value_scaled_for_v1_bulbs():
+    bulb = DummyBulb({'20': True, '21': 'colour', 'bright_value': '0',
+                      'colour_data': '00b401f403e8'})
+
+    level, mode = light_control.current_brightness(bulb)
+
+    assert (level, mode) == (255, 'colour')
+
+
+def test_type_a_colour_parsed_as_rgb():
+    assert light_control._parse_colour_str('00ff00007800ff')[:3] == (0, 255, 0)
+    h, s, v = light_control.current_hsv(DummyDevice('00ff00007800ff'))
+    assert (h, s, v) == pytest.approx((1 / 3, 1, 1))
+
+
+class DummyTuya:
+    """Records how tinytuya devices are constructed and driven."""
+
+    def __init__(self, dev_id, address=None, local_key='', cid=None, parent=None):
+        self.id = dev_id
+        self.address = address
+        self.cid = cid
+        self.parent = parent
+        self.calls = []
+
+    def set_socketPersistent(self, persist):
+        pass
+
+    def set_version(self, version):
+        pass
+
+    def status(self):
+        self.calls.append('status')
+        return {'dps': {'20': True}}
+
+    def turn_on(self, switch=True, nowait=False):
+        self.calls.append(('on', nowait))
+
+    def turn_off(self, switch=True, nowait=False):
+        self.calls.append(('off', nowait))
+
+    def set_colour(self, r, g, b, nowait=False):
+        self.calls.append(('colour', nowait))
+
+    def set_brightness(self, b, nowait=False):
+        self.calls.append(('brightness', nowait))
+
+
+def test_sub_devices_share_gateway_session(monkeypatch):
+    devices = {
+        'Ceiling': {'type': 'bulb', 'gwid': 'c', 'ip': '10.0.0.50', 'key': 'k1', 'version': 3.3, 'cid': 'c-node'},
+        'Flood': {'type': 'bulb', 'gwid': 'f', 'ip': '10.0.0.50', 'key': 'k2', 'version': 3.3, 'cid': 'f-node'},
+        'Spot': {'type': 'bulb', 'gwid': 's', 'ip': '10.0.0.50', 'key': 'k4', 'version': 3.3},
+        'Lamp': {'type': 'bulb', 'gwid': 'l', 'ip': '10.0.0.54', 'key': 'k3', 'version': 3.3, 'cid': 'l-node'},
+    }
+    gateways = {'10.0.0.50': {'gwid': 'hub', 'key': 'hk', 'version': 3.3}}
+    monkeypatch.setattr(light_control, 'devices', devices)
+    monkeypatch.setattr(light_control, 'gateways', gateways)
+    monkeypatch.setattr(light_control, 'device_class',
+                        {'bulb': DummyTuya, 'plug': DummyTuya, 'gateway': DummyTuya})
+    monkeypatch.setattr(light_control, '_gateways', {})
+    monkeypatch.setattr(light_control, '_sub_devices', {})
+
+    ceiling = light_control.get_device('Ceiling')
+    flood = light_control.get_device('Flood')
+    spot = light_control.get_device('Spot')
+    lamp = light_control.get_device('Lamp')
+
+    assert ceiling.parent is flood.parent
+    assert ceiling.parent.id == 'hub' and ceiling.parent.address == '10.0.0.50'
+    assert (ceiling.cid, flood.cid) == ('c-node', 'f-node')
+    assert ceiling.calls == [] and flood.calls == []
+    assert light_control.get_device('Ceiling') is ceiling
+    assert spot.parent is None and spot.address == '10.0.0.50'
+    assert lamp.parent is None and lamp.calls == ['status']
+
+    monkeypatch.setattr(light_control, 'BATCH_GATEWAY_DEVICES', False)
+    assert light_control.get_device('Flood').parent is None
+
+
+class DummyTuyaBulb(DummyTuya):
+    """Sub-device that, like tinytuya, must learn its DP layout first."""
+
+    bulb_configured = False
+    created = 0
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        time.sleep(0.01)
+        DummyTuyaBulb.created += 1
+
+    def set_bulb_type(self, bulb_type):
+        self.calls.append(('bulb_type', bulb_type))
+        self.bulb_configured = True
+
+    def status(self):
+        self.bulb_configured = True
+        return super().status()
+
+
+def test_batched_sub_devices_learn_layout_lazily(tmp_path, monkeypatch):
+    devices = {
+        'Ceiling': {'type': 'bulb', 'gwid': 'c', 'ip': '10.0.0.50', 'key': 'k1', 'version': 3.3, 'cid': 'c-node', 'bulb_type': 'B'},
+        'Flood': {'type': 'bulb', 'gwid': 'f', 'ip': '10.0.0.50', 'key': 'k2', 'version': 3.3, 'cid': 'f-node'},
+    }
+    gateways = {'10.0.0.50': {'gwid': 'hub', 'key': 'hk', 'version': 3.3}}
+    monkeypatch.setattr(light_control, 'devices', devices)
+    monkeypatch.setattr(light_control, 'gateways', gateways)
+    monkeypatch.setattr(light_control, 'device_class',
+                        {'bulb': DummyTuyaBulb, 'gateway': DummyTuya})
+    monkeypatch.setattr(light_control, '_gateways', {})
+    monkeypatch.setattr(light_control, '_sub_devices', {})
+    monkeypatch.setattr(light_control, '_shadow', {})
+    monkeypatch.setattr(light_control, '_profiles', {})
+
+    preset = {n: {'on': True, 'mode': 'colour', 'color': '#ff0000', 'value': 100}
+              for n in devices}
+    preset_name = str(tmp_path / 'preset')
+    with open(preset_name + '.json', 'w') as fh:
+        json.dump(preset, fh)
+    light_control.load_preset(preset_name)
+
+    ceiling = light_control.get_device('Ceiling')
+    flood = light_control.get_device('Flood')
+    assert ceiling.calls == [('bulb_type', 'B'), ('on', True),
+                             ('colour', True), ('brightness', True)]
+    assert flood.calls == ['status', ('on', True),
+                           ('colour', True), ('brightness', True)]
+    profile = light_control.device_profile(ceiling, poll=False)
+    assert profile['bright'] == (10, 1000)
+
+
+def test_sub_device_created_once(monkeypatch):
+    devices = {'Ceiling': {'type': 'bulb', 'gwid': 'c', 'ip': '10.0.0.50', 'key': 'k1', 'version': 3.3, 'cid': 'c-node'}}
+    monkeypatch.setattr(light_control, 'devices', devices)
+    monkeypatch.setattr(light_control, 'gateways', {'10.0.0.50': {'gwid': 'hub', 'key': 'hk', 'version': 3.3}})
+    monkeypatch.setattr(light_control, 'device_class',
+                        {'bulb': DummyTuyaBulb, 'gateway': DummyTuya})
+    monkeypatch.setattr(light_control, '_gateways', {})
+    monkeypatch.setattr(light_control, '_sub_devices', {})
+    monkeypatch.setattr(DummyTuyaBulb, 'created', 0)
+
+    threads = [threading.Thread(target=light_control.get_device, args=('Ceiling',))
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert DummyTuyaBulb.created == 1
+
+
+def test_frame_cache_follows_gateway_version(monkeypatch):
+    devices = {
+        'Ceiling': {'type': 'bulb', 'gwid': 'c', 'ip': '10.0.0.50', 'key': 'k1', 'version': 3.3, 'cid': 'c-node'},
+        'Flood': {'type': 'bulb', 'gwid': 'f', 'ip': '10.0.0.51', 'key': 'k2', 'version': 3.4, 'cid': 'f-node'},
+    }
+    gateways = {'10.0.0.50': {'gwid': 'hub', 'key': 'hk', 'version': 3.4},
+                '10.0.0.51': {'gwid': 'hub2', 'key': 'hk', 'version': 3.3}}
+    cached = []
+    monkeypatch.setattr(light_control, 'devices', devices)
+    monkeypatch.setattr(light_control, 'gateways', gateways)
+    monkeypatch.setattr(light_control, 'device_class',
+                        {'bulb': DummyTuya, 'plug': DummyTuya, 'gateway': DummyTuya})
+    monkeypatch.setattr(light_control, '_gateways', {})
+    monkeypatch.setattr(light_control, '_sub_devices', {})
+    monkeypatch.setattr(light_control, '_enable_frame_cache', cached.append)
+
+    light_control.get_device('Ceiling')
+    flood = light_control.get_device('Flood')
+
+    assert cached == [flood]
+
+
+def test_shared_ip_without_gateway_keeps_own_sessions(monkeypatch):
+    devices = {
+        'Ceiling': {'type': 'bulb', 'gwid': 'c', 'ip': '10.0.0.50', 'key': 'k1', 'version': 3.3},
+        'Flood': {'type': 'bulb', 'gwid': 'f', 'ip': '10.0.0.50', 'key': 'k2', 'version': 3.3, 'cid': 'f-node'},
+    }
+    monkeypatch.setattr(light_control, 'devices', devices)
+    monkeypatch.setattr(light_control, 'gateways', {})
+    monkeypatch.setattr(light_control, 'device_class',
+                        {'bulb': DummyTuya, 'plug': DummyTuya, 'gateway': DummyTuya})
+
+    for name in devices:
+        dev = light_control.get_device(name)
+        assert dev.parent is None and dev.address == '10.0.0.50'
+
+
+def test_load_preset_batches_gateway_devices(tmp_path, monkeypatch):
+    devices = {
+        'Ceiling': {'type': 'bulb', 'ip': '10.0.0.50', 'cid': 'c-node'},
+        'Flood': {'type': 'bulb', 'ip': '10.0.0.50', 'cid': 'f-node'},
+        'Lamp': {'type': 'bulb', 'ip': '10.0.0.54'},
+    }
+    bulbs = {name: DummyTuya(name) for name in devices}
+    monkeypatch.setattr(light_control, 'gateways', {'10.0.0.50': {}})
+    batches = []
+    apply_batch = light_control._apply_batch
+
+    def record_batch(batch, nowait):
+        batches.append(([name for name, _ in batch], nowait))
+        apply_batch(batch, nowait)
+
+    monkeypatch.setattr(light_control, 'devices', devices)
+    monkeypatch.setattr(light_control, 'get_device', lambda n: bulbs[n])
+    monkeypatch.setattr(light_control, '_apply_batch', record_batch)
+
+    preset = {n: {'on': True, 'mode': 'colour', 'color': '#ff0000', 'value': 100}
+              for n in devices}
+    preset_name = str(tmp_path / 'preset')
+    with open(preset_name + '.json', 'w') as fh:
+        json.dump(preset, fh)
+
+    light_control.load_preset(preset_name)
+
+    assert sorted(batches) == [(['Ceiling', 'Flood'], True), (['Lamp'], False)]
+    for name in ('Ceiling', 'Flood'):
+        assert bulbs[name].calls == [('on', True), ('colour', True), ('brightness', True)]
+    assert ('colour', False) in bulbs['Lamp'].calls
+
+
+class DummyRemote:
+    """Device whose reported status never reflects writes."""
+
+    def __init__(self, dev_id):
+        self.id = dev_id
+        self.polls = 0
+
+    def status(self):
+        self.polls += 1
+        return {'dps': {'20': True, '21': 'white', 'bright': '100'}}
+
+    def turn_off(self, switch=True, nowait=False):
+        return None
+
+
+def test_shard_writes_keep_their_age(monkeypatch):
+    monkeypatch.setattr(light_control, 'devices', {'A': {'gwid': 'A'}})
+    monkeypatch.setattr(light_control, '_shadow', {})
+    monkeypatch.setattr(light_control, '_sessions', {'A': DummyRemote('A')})
+    now = light_control.time.monotonic()
+    light_control._shadow['A'] = {'pending': {'bright': (500, now - 9.5)}}
+    light_control._switch(light_control._sessions['A'], False, nowait=True)
+
+    writes = light_control._shard_writes(['A'], since=now)
+    assert list(writes['A']) == ['on']
+    assert writes['A']['on'][1] < 1
+
+    monkeypatch.setattr(light_control, '_sessions', None)
+    light_control._shadow['A'] = {'pending': {'bright': (300, now)}}
+    light_control._merge_shard_writes(
+        {'A': {'bright': (500, 5.0), 'on': (False, 9.5)}})
+
+    pending = light_control._shadow['A']['pending']
+    assert pending['bright'] == (300, now)
+    assert now - pending['on'][1] == pytest.approx(9.5, abs=0.5)
+
+
+def test_sharded_writes_reach_coordinator_shadow(monkeypatch):
+    devices = {n: {'type': 'plug', 'gwid': n, 'ip': f'10.0.{i}.1'}
+               for i, n in enumerate(('A', 'B', 'C'))}
+    remotes = {n: DummyRemote(n) for n in devices}
+
+    def get_device(name):
+        if light_control._sessions is not None:
+            return light_control._sessions.setdefault(name, DummyRemote(name))
+        return remotes[name]
+
+    monkeypatch.setattr(light_control, 'devices', devices)
+    monkeypatch.setattr(light_control, 'get_device', get_device)
+    monkeypatch.setattr(light_control, 'SHARD_WORKERS', 2)
+    monkeypatch.setattr(light_control, '_shard_executors', [])
+
+    try:
+        assert light_control._read_dps(remotes['A'])['20'] is True
+        assert light_control.switch_all(False) == ['A', 'B', 'C']
+    finally:
+        for executor in light_control._shard_executors:
+            executor.shutdown()
+
+    assert light_control._read_dps(remotes['A'])['20'] is False
+    assert remotes['A'].polls == 1
+
+
+def test_frame_cache_evicts_least_recently_used(monkeypatch):
+    monkeypatch.setattr(light_control.tinytuya, 'CONTROL', 7, raising=False)
+    monkeypatch.setattr(light_control, '_frame_cache', collections.OrderedDict())
+    monkeypatch.setattr(light_control, 'FRAME_CACHE_SIZE', 2)
+    dev = DummyEncoder()
+    light_control._enable_frame_cache(dev)
+
+    dev.generate_payload(7, {'25': 1})
+    dev.generate_payload(7, {'25': 2})
+    dev.generate_payload(7, {'25': 1})
+    dev.generate_payload(7, {'25': 3})
+
+    cached = [dict(key[2]) for key in light_control._frame_cache]
+    assert cached == [{'25': 1}, {'25': 3}]
+
+
+def test_sharded_states_include_coordinator_writes(monkeypatch):
+    devices = {n: {'type': 'plug', 'gwid': n, 'ip': f'10.0.{i}.1'}
+               for i, n in enumerate(('A', 'B', 'C'))}
+    remotes = {n: DummyRemote(n) for n in devices}
+
+    def get_device(name):
+        if light_control._sessions is not None:
+            return light_control._sessions.setdefault(name, DummyRemote(name))
+        return remotes[name]
+
+    monkeypatch.setattr(light_control, 'devices', devices)
+    monkeypatch.setattr(light_control, 'get_device', get_device)
+    monkeypatch.setattr(light_control, 'SHARD_WORKERS', 2)
+    monkeypatch.setattr(light_control, '_shard_executors', [])
+    monkeypatch.setattr(light_control, '_shadow', {})
+
+    light_control._switch(remotes['A'], False, nowait=True)
+    try:
+        states = light_control.get_all_states()
+    finally:
+        for executor in light_control._shard_executors:
+            executor.shutdown()
+
+    assert states['A'] == {'on': False}
+    assert states['B'] == {'on': True}
@@ -0,0 +1,119 @@
+import json
+import pytest
+import sys
+import types
+
+# Stub tinytuya before importing the modules under test as it is not
+# available in the test environment.
+tinytuya = types.ModuleType('tinytuya')
+tinytuya.BulbDevice = object
+tinytuya.OutletDevice = object
+tinytuya.Device = object
+sys.modules.setdefault('tinytuya', tinytuya)
+
+import light_control
+import replay
+
+
+def test_record_and_replay_against_farm(tmp_path, monkeypatch):
+    trace = tmp_path / 'trace.jsonl'
+    farm = replay.SimulatedFarm(latency=0)
+    monkeypatch.setattr(light_control, 'device_class', dict(light_control.device_class))
+    farm.install()
+    monkeypatch.setattr(light_control, 'TRACE_FILE', str(trace))
+    monkeypatch.chdir(tmp_path)
+
+    light_control.main(['light_control.py', 'Lamp', 'on'])
+    light_control.main(['light_control.py', 'Lamp', 'hsv', '120', '100', '50'])
+    light_control.save_preset('evening')
+
+    entries = replay.load_trace(trace)
+    assert [(e['verb'], e['device'], e['args']) for e in entries] == [
+        ('on', 'Lamp', []),
+        ('hsv', 'Lamp', ['120', '100', '50']),
+        ('save_preset', None, ['evening']),
+    ]
+    assert farm.states['087537652462ab50b898']['20'] is True
+
+    entries.append({'ts': entries[-1]['ts'], 'verb': 'bogus',
+                    'device': 'Lamp', 'args': []})
+    summary = replay.replay(entries, speed=0, concurrency=2, warm=True)
+
+    assert summary['requests'] == 4
+    assert summary['errors'] == 1
+    assert summary['error_rate'] == 0.25
+    assert summary['p50'] <= summary['p99'] <= summary['max']
+    assert light_control.TRACE_FILE == str(trace)
+    assert len(replay.load_trace(trace)) == 3
+
+
+def test_farm_reports_errors():
+    farm = replay.SimulatedFarm(latency=0, error_rate=1.0)
+    dev = farm.device('id', '10.0.0.1', 'key')
+
+    assert 'Error' in dev.status()
+    assert dev.turn_on(nowait=True) is None
+    assert 'id' not in farm.states
+
+
+def test_api_keywords_traced_and_replayed(tmp_path, monkeypatch):
+    trace = tmp_path / 'trace.jsonl'
+    calls = []
+    monkeypatch.setattr(light_control, 'TRACE_FILE', str(trace))
+    monkeypatch.setattr(light_control, '_switch_devices',
+                        lambda names, on: calls.append(on) or names)
+
+    light_control.switch_all(on=True)
+    entries = replay.load_trace(trace)
+    assert entries[0]['kwargs'] == {'on': True}
+
+    replay.invoke(entries[0])
+    assert calls == [True, True]
+
+
+def test_sharded_all_on_traced_once(tmp_path, monkeypatch):
+    trace = tmp_path / 'trace.jsonl'
+    monkeypatch.setattr(light_control, 'TRACE_FILE', str(trace))
+    monkeypatch.setattr(light_control, 'SHARD_WORKERS', 2)
+    monkeypatch.setattr(light_control, 'switch_all', light_control._traced(
+        lambda on: []))
+
+    try:
+        light_control.main(['light_control.py', 'all_on'])
+    except SystemExit:
+        pass
+
+    assert [e['verb'] for e in replay.load_trace(trace)] == ['all_on']
+
+
+def test_cli_entries_replayed_cold(monkeypatch):
+    farm = replay.SimulatedFarm(latency=0)
+    monkeypatch.setattr(light_control, 'device_class', dict(light_control.device_class))
+    farm.install()
+    resets = []
+    reset_state = light_control._reset_state
+    monkeypatch.setattr(light_control, '_reset_state',
+                        lambda: resets.append(dict(light_control._shadow)) or reset_state())
+
+    entries = [{'ts': 0, 'verb': 'h', 'device': 'Lamp', 'args': [120]}] * 3
+    entries.append({'ts': 0, 'verb': 'get_all_states', 'device': None, 'args': []})
+    summary = replay.replay(entries, speed=0)
+
+    assert summary['errors'] == 0
+    assert len(resets) == 3
+    assert '087537652462ab50b898' in resets[-1]
+    assert light_control._shadow
+
+    resets.clear()
+    replay.replay(entries, speed=0, warm=True)
+    assert resets == []
+
+
+def test_cold_replay_rejects_concurrency(monkeypatch):
+    cli = {'ts': 0, 'verb': 'on', 'device': 'Lamp', 'args': []}
+    api = {'ts': 0, 'verb': 'get_all_states', 'device': None, 'args': []}
+    monkeypatch.setattr(light_control, 'get_all_states', lambda: {})
+
+    with pytest.raises(ValueError):
+        replay.replay([api, cli], speed=0, concurrency=4)
+    assert replay.replay([api] * 4, speed=0, concurrency=4)['errors'] == 0